@@ -2,10 +2,18 @@
 Core settings and configuration for the Content Automation System
 """
 
+import logging
 import os
+import sys
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
-from pydantic import Field
+
+# Must be set before CUDA initializes; avoids the fragmentation empty_cache() used to paper over
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
+import torch
+from pydantic import Field, PrivateAttr
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -15,25 +23,11 @@ class Settings(BaseSettings):
     ollama_host: str = Field(default="http://localhost:11434", env="OLLAMA_HOST")
     ollama_no_gpu: bool = Field(default=False, env="OLLAMA_NO_GPU")
     
-    # Hugging Face
-    huggingface_token: Optional[str] = Field(default=None, env="HUGGINGFACE_TOKEN")
-    
-    # Google Drive Integration
-    google_drive_credentials: Optional[str] = Field(default=None, env="GOOGLE_DRIVE_CREDENTIALS")
-    google_drive_folder_id: Optional[str] = Field(default=None, env="GOOGLE_DRIVE_FOLDER_ID")
-    
-    # Social Media Platform APIs
-    instagram_username: Optional[str] = Field(default=None, env="INSTAGRAM_USERNAME")
-    instagram_password: Optional[str] = Field(default=None, env="INSTAGRAM_PASSWORD")
-    twitter_api_key: Optional[str] = Field(default=None, env="TWITTER_API_KEY")
-    twitter_api_secret: Optional[str] = Field(default=None, env="TWITTER_API_SECRET")
-    twitter_access_token: Optional[str] = Field(default=None, env="TWITTER_ACCESS_TOKEN")
-    twitter_access_secret: Optional[str] = Field(default=None, env="TWITTER_ACCESS_SECRET")
-    
     # Content Generation Settings
     default_image_size: str = Field(default="1024x1024", env="DEFAULT_IMAGE_SIZE")
     max_caption_length: int = Field(default=2200, env="MAX_CAPTION_LENGTH")
     default_hashtag_count: int = Field(default=15, env="DEFAULT_HASHTAG_COUNT")
+    png_compress_level: int = Field(default=6, env="PNG_COMPRESS_LEVEL")  # 0-9, 1 is fastest
     
     # Scheduling
     content_schedule_timezone: str = Field(default="America/New_York", env="CONTENT_SCHEDULE_TIMEZONE")
@@ -47,7 +41,6 @@ class Settings(BaseSettings):
     # n8n Workflow Engine
     n8n_host: str = Field(default="http://localhost:5678", env="N8N_HOST")
     n8n_auth_user: str = Field(default="admin", env="N8N_AUTH_USER")
-    n8n_auth_password: Optional[str] = Field(default=None, env="N8N_AUTH_PASSWORD")
     
     # Redis (for task queuing)
     redis_url: str = Field(default="redis://localhost:6379/0", env="REDIS_URL")
@@ -57,6 +50,9 @@ class Settings(BaseSettings):
     prompt_enhancer_model: str = Field(default="brxce/stable-diffusion-prompt-generator", env="PROMPT_ENHANCER_MODEL")
     caption_model: str = Field(default="llama3:latest", env="CAPTION_MODEL")
     text_model: str = Field(default="mistral:latest", env="TEXT_MODEL")
+    compile_transformer: bool = Field(default=False, env="COMPILE_TRANSFORMER")  # torch.compile SD3 on load
+    quantize_transformer: bool = Field(default=False, env="QUANTIZE_TRANSFORMER")  # int8 weights via optimum-quanto
+    warmup: bool = Field(default=True, env="WARMUP")  # Preload SD3 when the MCP server starts
     
     # Development
     debug: bool = Field(default=True, env="DEBUG")
@@ -65,13 +61,50 @@ class Settings(BaseSettings):
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
+        extra = "ignore"  # .env also carries the Secrets fields
     
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        # Ensure directories exist
-        self.local_asset_path.mkdir(parents=True, exist_ok=True)
-        self.output_path.mkdir(parents=True, exist_ok=True)
-        self.temp_path.mkdir(parents=True, exist_ok=True)
+    _paths_ready: bool = PrivateAttr(default=False)
+    
+    def ensure_paths(self):
+        """Create the storage directories; done on first use rather than on import"""
+        if self._paths_ready:
+            return
+        for path in (self.local_asset_path, self.output_path, self.temp_path):
+            path.mkdir(parents=True, exist_ok=True)
+        self._paths_ready = True
+    
+    def __getattr__(self, name):
+        # Credentials stay readable as settings.<field>, but are only loaded on first access
+        if name in Secrets.model_fields:
+            return getattr(get_secrets(), name)
+        return super().__getattr__(name)
+
+
+class Secrets(BaseSettings):
+    """Credentials for external services, loaded on first access via get_secrets() or settings.<field>"""
+    
+    # Hugging Face
+    huggingface_token: Optional[str] = Field(default=None, env="HUGGINGFACE_TOKEN")
+    
+    # Google Drive Integration
+    google_drive_credentials: Optional[str] = Field(default=None, env="GOOGLE_DRIVE_CREDENTIALS")
+    google_drive_folder_id: Optional[str] = Field(default=None, env="GOOGLE_DRIVE_FOLDER_ID")
+    
+    # Social Media Platform APIs
+    instagram_username: Optional[str] = Field(default=None, env="INSTAGRAM_USERNAME")
+    instagram_password: Optional[str] = Field(default=None, env="INSTAGRAM_PASSWORD")
+    twitter_api_key: Optional[str] = Field(default=None, env="TWITTER_API_KEY")
+    twitter_api_secret: Optional[str] = Field(default=None, env="TWITTER_API_SECRET")
+    twitter_access_token: Optional[str] = Field(default=None, env="TWITTER_ACCESS_TOKEN")
+    twitter_access_secret: Optional[str] = Field(default=None, env="TWITTER_ACCESS_SECRET")
+    
+    # n8n Workflow Engine
+    n8n_auth_password: Optional[str] = Field(default=None, env="N8N_AUTH_PASSWORD")
+    
+    class Config:
+        env_file = ".env"
+        env_file_encoding = "utf-8"
+        extra = "ignore"
 
 # Global settings instance
 settings = Settings()
@@ -79,16 +112,39 @@ settings = Settings()
 # Utility functions
 def get_image_size_tuple(size_str: str = None) -> tuple[int, int]:
     """Convert size string like '1024x1024' to tuple (1024, 1024)"""
-    size_str = size_str or settings.default_image_size
+    # Resolve the default first so None shares a cache entry with the explicit size
+    return _parse_image_size(size_str or settings.default_image_size)
+
+@lru_cache(maxsize=16)
+def _parse_image_size(size_str: str) -> tuple[int, int]:
     width, height = map(int, size_str.split('x'))
     return width, height
 
+def configure_logging():
+    """Send logs to stderr at LOG_LEVEL; stdout is the MCP transport and must stay clean"""
+    logging.basicConfig(
+        level=settings.log_level.upper(),
+        stream=sys.stderr,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+@lru_cache(maxsize=1)
+def get_secrets() -> Secrets:
+    """Get service credentials, reading them from the environment on first call"""
+    return Secrets()
+
+@lru_cache(maxsize=1)
 def get_device():
-    """Get the appropriate device for model inference"""
-    import torch
+    """Get the appropriate device for model inference (probed once, then cached)"""
+    mps_backend = getattr(torch.backends, "mps", None)
+    mps_ok = (
+        mps_backend is not None
+        and mps_backend.is_built()
+        and mps_backend.is_available()
+    )
     if torch.cuda.is_available():
         return "cuda"
-    elif torch.backends.mps.is_available():
+    elif mps_ok:
         return "mps"
     else:
         return "cpu" 
\ No newline at end of file
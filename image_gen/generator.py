@@ -4,8 +4,17 @@ Optimized for RTX 2070 SUPER (8GB VRAM)
 """
 
 import asyncio
+import contextlib
+import hashlib
+import io
+import itertools
+import logging
+import os
 import time
+import uuid
 import torch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Dict, Any
 from PIL import Image
@@ -14,156 +23,383 @@ import ollama
 from diffusers import StableDiffusion3Pipeline
 from core.settings import settings, get_device, get_image_size_tuple
 
+logger = logging.getLogger(__name__)
+
+# Below this much VRAM the full SD3 pipeline does not fit, so weights are offloaded
+FULL_GPU_VRAM_BYTES = 12 * 1024**3
+
+# Rough activation budget per 1024x1024 image (per CFG branch) when sizing batches
+BATCH_IMAGE_VRAM_BYTES = int(1.5 * 1024**3)
+
+
+# Output filename parts: a per-start token (PIDs get reused, e.g. PID 1 in containers)
+# and a process-wide sequence shared by every ImageGenerator
+_RUN_ID = uuid.uuid4().hex[:8]
+_output_counter = itertools.count()
+
+# Shared by generate() defaults and the compile warmup so both trace the same shapes
+DEFAULT_GUIDANCE_SCALE = 7.0
+
+# Bounds for the prompt enhancement cache (in-memory entries, files under temp_path)
+ENHANCE_CACHE_MAX_ENTRIES = 256
+ENHANCE_CACHE_MAX_FILES = 1024
+
+ENHANCEMENT_TEMPLATE = """Transform this basic description into a detailed, artistic prompt for Stable Diffusion:
+            
+Basic idea: {basic_prompt}
+Style preference: {style_preference}
+
+Make it detailed with artistic elements, lighting, composition, and quality modifiers."""
+
 
 class ImageGenerator:
     """Handles image generation using Stable Diffusion 3 Medium"""
     
     def __init__(self):
         self.pipeline = None
+        self._offload = False  # Set by load_model() when weights live on the CPU
+        self._peak_vram_logged = False
         self.device = get_device()
-        self.ollama_client = ollama.Client(host=settings.ollama_host)
+        settings.ensure_paths()  # Images and cached prompts are written under these
+        self.ollama_client = ollama.AsyncClient(host=settings.ollama_host)
+        self._enhance_cache: OrderedDict[str, str] = OrderedDict()  # In-process LRU front for the on-disk cache
+        # One worker so concurrent requests queue up instead of contending for VRAM
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sd3")
         
     def load_model(self):
         """Load SD3 Medium pipeline with memory optimizations"""
         if self.pipeline is not None:
             return
             
-        print(f"Loading Stable Diffusion 3 Medium on {self.device}...")
+        logger.info("Loading Stable Diffusion 3 Medium on %s...", self.device)
         
-        # Load with memory optimizations for 8GB VRAM
-        self.pipeline = StableDiffusion3Pipeline.from_pretrained(
+        if settings.quantize_transformer:
+            # Fail before the expensive from_pretrained() if the optional dependency is missing
+            from optimum.quanto import freeze, qint8, quantize
+        
+        # Load with memory optimizations for 8GB VRAM. The pipeline is configured locally and only
+        # published once everything succeeded, so a failed load leaves self.pipeline as None and
+        # the next preload() retries from scratch
+        pipeline = StableDiffusion3Pipeline.from_pretrained(
             settings.sd3_model_path,
             torch_dtype=torch.float16,  # Half precision for memory efficiency
             use_safetensors=True,
             variant="fp16"
         )
         
+        # int8 weight-only transformer halves weight bandwidth per step; VAE and text encoders stay fp16
+        if settings.quantize_transformer:
+            quantize(pipeline.transformer, weights=qint8)
+            freeze(pipeline.transformer)
+        
         # Memory optimizations
-        self.pipeline.enable_model_cpu_offload()  # Offload to CPU when not in use
-        self.pipeline.enable_vae_slicing()        # Process VAE in slices
-        self.pipeline.enable_attention_slicing()  # Reduce memory for attention
+        pipeline.enable_vae_slicing()  # Decode batches one image at a time
+        
+        # No attention slicing: SD3's default joint processors already run fused SDPA kernels
+        
+        # Offload hooks and an explicit .to() fight each other, so pick one
+        offload = self.device == "cuda" and self._total_vram() < FULL_GPU_VRAM_BYTES
+        if offload:
+            pipeline.enable_sequential_cpu_offload()  # Stream weights to GPU on demand
+        else:
+            pipeline = pipeline.to(self.device)
         
-        # Move to GPU
-        self.pipeline = self.pipeline.to(self.device)
+        # CUDA graphs need the weights resident on the GPU, so skip compiling when offloading
+        if settings.compile_transformer and self.device == "cuda" and not offload:
+            pipeline.transformer = torch.compile(
+                pipeline.transformer, mode="reduce-overhead", dynamic=False
+            )
+            # Pay the compile cost now rather than on the first user request. With dynamic=False
+            # this only covers the default size and guidance (CFG doubles the batch when > 1);
+            # other sizes or guidance values still compile on first use
+            width, height = get_image_size_tuple(settings.default_image_size)
+            self._invoke(pipeline, "warmup", width, height, 1, DEFAULT_GUIDANCE_SCALE)
+        
+        # Peak VRAM is reported after the first real generation (see _run_pipeline)
+        self._peak_vram_logged = False
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
         
-        print(f"✅ Model loaded on {self.device}")
+        self._offload = offload
+        self.pipeline = pipeline
+        logger.info("✅ Model loaded on %s", self.device)
+    
+    async def preload(self):
+        """Load the model on the worker thread without blocking the event loop"""
+        if self.pipeline is None:
+            # Shares the pipeline worker, so generations queue behind an in-flight load
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.load_model)
+    
+    def _total_vram(self) -> int:
+        """Total memory of the first CUDA device in bytes"""
+        return torch.cuda.get_device_properties(0).total_memory
     
     async def enhance_prompt(self, basic_prompt: str, style_preference: str = None) -> str:
         """Enhance a basic prompt using Ollama's prompt generator"""
+        # Build enhancement prompt
+        enhancement_request = ENHANCEMENT_TEMPLATE.format(
+            basic_prompt=basic_prompt,
+            style_preference=style_preference or 'creative and professional'
+        )
+        # Keying on the full request means a template change invalidates old entries
+        key = hashlib.sha256(
+            "\0".join((settings.prompt_enhancer_model, enhancement_request)).encode()
+        ).hexdigest()
+        
+        cached = self._cached_enhancement(key)
+        if cached is not None:
+            return cached
+        
         try:
-            # Build enhancement prompt
-            enhancement_request = f"""Transform this basic description into a detailed, artistic prompt for Stable Diffusion:
-            
-Basic idea: {basic_prompt}
-Style preference: {style_preference or 'creative and professional'}
-
-Make it detailed with artistic elements, lighting, composition, and quality modifiers."""
-
-            response = self.ollama_client.generate(
+            response = await self.ollama_client.generate(
                 model=settings.prompt_enhancer_model,
                 prompt=enhancement_request,
                 stream=False
             )
             
             enhanced = response['response'].strip()
-            print(f"📝 Enhanced prompt: {enhanced}")
+            logger.debug("📝 Enhanced prompt: %s", enhanced)
+            self._store_enhancement(key, enhanced)
             return enhanced
             
         except Exception as e:
-            print(f"⚠️ Prompt enhancement failed: {e}")
+            logger.warning("⚠️ Prompt enhancement failed: %s", e)
             # Fallback to basic prompt with some enhancements
             return f"{basic_prompt}, high quality, detailed, professional photography"
     
+    def _cached_enhancement(self, key: str) -> Optional[str]:
+        """Look up an enhancement in memory, then on disk, refreshing its recency"""
+        if key in self._enhance_cache:
+            self._enhance_cache.move_to_end(key)
+            return self._enhance_cache[key]
+        cache_path = self._enhance_cache_path(key)
+        if not cache_path.exists():
+            return None
+        enhanced = cache_path.read_text(encoding="utf-8")
+        cache_path.touch()  # mtime is the on-disk recency
+        self._remember_enhancement(key, enhanced)
+        return enhanced
+    
+    def _store_enhancement(self, key: str, enhanced: str):
+        """Cache an enhancement in memory and on disk, evicting the least recently used files"""
+        self._remember_enhancement(key, enhanced)
+        self._enhance_cache_path(key).write_text(enhanced, encoding="utf-8")
+        
+        files = list(settings.temp_path.glob("enh_*.txt"))
+        if len(files) > ENHANCE_CACHE_MAX_FILES:
+            files.sort(key=lambda f: f.stat().st_mtime)
+            for stale in files[:len(files) - ENHANCE_CACHE_MAX_FILES]:
+                stale.unlink(missing_ok=True)
+    
+    def _remember_enhancement(self, key: str, enhanced: str):
+        """Add to the in-memory front cache, dropping the least recently used entry when full"""
+        self._enhance_cache[key] = enhanced
+        self._enhance_cache.move_to_end(key)
+        if len(self._enhance_cache) > ENHANCE_CACHE_MAX_ENTRIES:
+            self._enhance_cache.popitem(last=False)
+    
+    def _enhance_cache_path(self, key: str) -> Path:
+        """On-disk location of a cached prompt enhancement"""
+        return settings.temp_path / f"enh_{key}.txt"
+    
     async def generate(
         self, 
         prompt: str,
         style: Optional[str] = None,
         size: str = "1024x1024",
         steps: int = 30,
-        guidance_scale: float = 7.0,
+        guidance_scale: float = DEFAULT_GUIDANCE_SCALE,
         enhance_prompt: bool = True
     ) -> Dict[str, Any]:
         """Generate an image from a text prompt"""
         
         # Load model if not already loaded
-        self.load_model()
+        await self.preload()
         
-        # Enhance the prompt if requested
-        if enhance_prompt:
-            prompt = await self.enhance_prompt(prompt, style)
-        elif style:
-            prompt = f"{prompt}, {style} style"
+        prompt = await self._prepare_prompt(prompt, style, enhance_prompt)
         
         # Parse size
         width, height = get_image_size_tuple(size)
         
         # Generate image
-        print(f"🎨 Generating {width}x{height} image...")
-        print(f"📋 Prompt: {prompt}")
+        logger.info("🎨 Generating %dx%d image...", width, height)
+        logger.debug("📋 Prompt: %s", prompt)
         
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         # Generate with error handling
         try:
-            with torch.autocast(self.device):
-                image = self.pipeline(
-                    prompt=prompt,
-                    width=width,
-                    height=height,
-                    num_inference_steps=steps,
-                    guidance_scale=guidance_scale,
-                    num_images_per_prompt=1,
-                ).images[0]
-            
-            generation_time = time.time() - start_time
-            
-            # Save image
-            timestamp = int(time.time())
-            filename = f"generated_{timestamp}_{width}x{height}.png"
-            image_path = settings.output_path / filename
-            image.save(image_path)
-            
-            print(f"✅ Generated in {generation_time:.2f}s: {image_path}")
+            images = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._run_pipeline, prompt, width, height, steps, guidance_scale
+            )
+            image = images[0]
             
-            # Convert to bytes for MCP
-            import io
-            img_bytes = io.BytesIO()
-            image.save(img_bytes, format='PNG')
-            img_bytes.seek(0)
+            generation_time = time.perf_counter() - start_time
             
-            return {
-                "image_path": str(image_path),
-                "image_data": img_bytes.getvalue(),
-                "prompt": prompt,
-                "size": f"{width}x{height}",
-                "generation_time": generation_time,
-                "steps": steps,
-                "guidance_scale": guidance_scale
-            }
+            return self._save_image(image, prompt, width, height, generation_time, steps, guidance_scale)
             
         except torch.cuda.OutOfMemoryError:
             # Handle VRAM overflow
             torch.cuda.empty_cache()
-            print("⚠️ CUDA out of memory. Try reducing image size or steps.")
+            logger.error("⚠️ CUDA out of memory. Try reducing image size or steps.")
             raise
         except Exception as e:
-            print(f"❌ Generation failed: {e}")
+            logger.error("❌ Generation failed: %s", e)
             raise
     
-    async def generate_batch(self, prompts: list[str], **kwargs) -> list[Dict[str, Any]]:
-        """Generate multiple images in sequence"""
+    async def generate_batch(
+        self,
+        prompts: list[str],
+        style: Optional[str] = None,
+        size: str = "1024x1024",
+        steps: int = 30,
+        guidance_scale: float = DEFAULT_GUIDANCE_SCALE,
+        enhance_prompt: bool = True
+    ) -> list[Dict[str, Any]]:
+        """Generate multiple images, running prompts through the pipeline in batches"""
+        await self.preload()
+        
+        prompts = [await self._prepare_prompt(p, style, enhance_prompt) for p in prompts]
+        width, height = get_image_size_tuple(size)
+        max_batch = self._max_batch_size(width, height, guidance_scale)
+        
         results = []
-        for i, prompt in enumerate(prompts):
-            print(f"\n🔄 Generating image {i+1}/{len(prompts)}")
-            result = await self.generate(prompt, **kwargs)
-            results.append(result)
+        i = 0
+        while i < len(prompts):
+            chunk = prompts[i:i + max_batch]
+            logger.info("🔄 Generating images %d-%d/%d", i + 1, i + len(chunk), len(prompts))
             
-            # Clear cache between generations
-            if torch.cuda.is_available():
+            start_time = time.perf_counter()
+            try:
+                images = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._run_pipeline, chunk, width, height, steps, guidance_scale
+                )
+            except torch.cuda.OutOfMemoryError:
                 torch.cuda.empty_cache()
+                if max_batch == 1:
+                    logger.error("⚠️ CUDA out of memory. Try reducing image size or steps.")
+                    raise
+                # The estimate was too optimistic; retry this chunk at half the size
+                max_batch //= 2
+                logger.warning("⚠️ CUDA out of memory, retrying with batch size %d", max_batch)
+                continue
+            
+            # Time is shared by the whole chunk, so report it per image
+            generation_time = (time.perf_counter() - start_time) / len(chunk)
+            
+            for prompt, image in zip(chunk, images):
+                results.append(
+                    self._save_image(image, prompt, width, height, generation_time, steps, guidance_scale)
+                )
+            i += len(chunk)
         
         return results
     
+    async def _prepare_prompt(self, prompt: str, style: Optional[str], enhance_prompt: bool) -> str:
+        """Enhance the prompt if requested, otherwise append the style"""
+        if enhance_prompt:
+            return await self.enhance_prompt(prompt, style)
+        elif style:
+            return f"{prompt}, {style} style"
+        return prompt
+    
+    def _run_pipeline(
+        self,
+        prompt: str | list[str],
+        width: int,
+        height: int,
+        steps: int,
+        guidance_scale: float
+    ) -> list[Image.Image]:
+        """Blocking pipeline call; runs on the generator's worker thread"""
+        images = self._invoke(self.pipeline, prompt, width, height, steps, guidance_scale)
+        
+        # With offloading the weights only reach VRAM during a run, so measure after one
+        if self.device == "cuda" and not self._peak_vram_logged:
+            logger.info(
+                "📊 Peak VRAM for first generation: %.2f GB (quantized transformer: %s)",
+                torch.cuda.max_memory_allocated() / 1024**3,
+                settings.quantize_transformer,
+            )
+            self._peak_vram_logged = True
+        return images
+    
+    def _invoke(
+        self,
+        pipeline: StableDiffusion3Pipeline,
+        prompt: str | list[str],
+        width: int,
+        height: int,
+        steps: int,
+        guidance_scale: float
+    ) -> list[Image.Image]:
+        """Run a pipeline under inference mode and the device's autocast"""
+        # inference_mode is thread-local, so it has to be entered on the calling (worker) thread
+        with torch.inference_mode(), self._autocast():
+            return pipeline(
+                prompt=prompt,
+                width=width,
+                height=height,
+                num_inference_steps=steps,
+                guidance_scale=guidance_scale,
+                num_images_per_prompt=1,
+            ).images
+    
+    def _autocast(self):
+        """Autocast context for inference; only pays off on CUDA, degrades CPU/MPS throughput"""
+        if self.device == "cuda":
+            return torch.autocast("cuda", dtype=torch.float16)
+        return contextlib.nullcontext()
+    
+    def _max_batch_size(self, width: int, height: int, guidance_scale: float) -> int:
+        """Estimate how many images of the given size fit in free VRAM at once"""
+        if self.device != "cuda":
+            return 1
+        free_bytes, _ = torch.cuda.mem_get_info()
+        if self._offload:
+            # Offloaded weights still stream through VRAM, so keep room for the transformer
+            free_bytes -= sum(p.numel() * p.element_size() for p in self.pipeline.transformer.parameters())
+        # Classifier-free guidance (guidance_scale > 1) doubles the transformer batch
+        cfg_factor = 2 if guidance_scale > 1 else 1
+        per_image = BATCH_IMAGE_VRAM_BYTES * cfg_factor * (width * height) / (1024 * 1024)
+        return max(1, int(free_bytes // per_image))
+    
+    def _save_image(
+        self,
+        image: Image.Image,
+        prompt: str,
+        width: int,
+        height: int,
+        generation_time: float,
+        steps: int,
+        guidance_scale: float
+    ) -> Dict[str, Any]:
+        """Encode and save a generated image, returning the result payload"""
+        # Encode once; the same PNG bytes go to disk and to MCP.
+        # With no getbuffer() view open, getvalue() hands over the internal buffer without a copy,
+        # whereas bytes(getbuffer()) would copy it
+        img_bytes = io.BytesIO()
+        image.save(img_bytes, format='PNG', compress_level=settings.png_compress_level)
+        image_data = img_bytes.getvalue()
+        img_bytes.close()
+        
+        # Save image (run id + pid + counter stay unique across restarts, instances and same-second outputs)
+        filename = f"generated_{_RUN_ID}_{os.getpid()}_{next(_output_counter)}_{width}x{height}.png"
+        image_path = settings.output_path / filename
+        image_path.write_bytes(image_data)
+        
+        logger.info("✅ Generated in %.2fs: %s", generation_time, image_path)
+        
+        return {
+            "image_path": str(image_path),
+            "image_data": image_data,
+            "prompt": prompt,
+            "size": f"{width}x{height}",
+            "generation_time": generation_time,
+            "steps": steps,
+            "guidance_scale": guidance_scale
+        }
+    
     def unload_model(self):
         """Free up VRAM by unloading the model"""
         if self.pipeline is not None:
@@ -171,4 +407,4 @@ Make it detailed with artistic elements, lighting, composition, and quality modi
             self.pipeline = None
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
-            print("🗑️ Model unloaded from memory") 
\ No newline at end of file
+            logger.info("🗑️ Model unloaded from memory") 
\ No newline at end of file
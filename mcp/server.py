@@ -4,6 +4,7 @@ Exposes tools for Claude to interact with the content generation pipeline
 """
 
 import asyncio
+import logging
 from typing import Any, Sequence
 from mcp.server import Server
 from mcp.server.models import InitializationOptions
@@ -13,7 +14,7 @@ from mcp.types import (
 )
 
 # Import our core modules
-from core.settings import settings
+from core.settings import settings, configure_logging
 from image_gen.generator import ImageGenerator
 from design.compositor import DesignCompositor
 from publishing.scheduler import ContentScheduler
@@ -26,6 +27,10 @@ scheduler = ContentScheduler()
 caption_gen = CaptionGenerator()
 
 server = Server("content-automation")
+logger = logging.getLogger(__name__)
+
+# Strong reference to the startup model load; the event loop only keeps weak ones
+_preload_task: asyncio.Task | None = None
 
 @server.list_tools()
 async def handle_list_tools() -> list[Tool]:
@@ -195,19 +200,28 @@ async def handle_call_tool(name: str, arguments: dict[str, Any]) -> list[TextCon
 
 async def create_complete_post(theme: str, platform: str, tone: str, include_hashtags: bool):
     """Create a complete social media post with image and caption"""
-    # Generate image based on theme
-    image_result = await image_gen.generate(
-        prompt=f"{theme} content for {platform}",
-        style="professional" if tone == "professional" else "creative"
-    )
+    # The caption only needs the theme, so it is written while the image renders
+    try:
+        async with asyncio.TaskGroup() as tg:
+            # Generate image based on theme
+            image_task = tg.create_task(image_gen.generate(
+                prompt=f"{theme} content for {platform}",
+                style="professional" if tone == "professional" else "creative"
+            ))
+            
+            # Generate caption
+            caption_task = tg.create_task(caption_gen.generate(
+                theme=theme,
+                platform=platform,
+                tone=tone,
+                include_hashtags=include_hashtags
+            ))
+    except* Exception as eg:
+        # Surface the real error to the MCP client rather than a TaskGroup ExceptionGroup
+        raise eg.exceptions[0] from None
     
-    # Generate caption
-    caption = await caption_gen.generate(
-        theme=theme,
-        platform=platform,
-        tone=tone,
-        include_hashtags=include_hashtags
-    )
+    image_result = image_task.result()
+    caption = caption_task.result()
     
     return {
         "image_path": image_result["image_path"],
@@ -221,7 +235,21 @@ async def analyze_performance(time_period: str, metric: str):
     # This would integrate with platform APIs to get real metrics
     return f"Analysis for {time_period}: {metric} trending upward"
 
+def _report_preload(task: asyncio.Task):
+    """Surface a failed startup model load instead of waiting for the first tool call"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("❌ Model preload failed: %s", task.exception(), exc_info=task.exception())
+
 async def main():
+    configure_logging()
+    settings.ensure_paths()
+    
+    # Load SD3 while the client negotiates capabilities so the first request only pays inference
+    if settings.warmup:
+        global _preload_task
+        _preload_task = asyncio.create_task(image_gen.preload())
+        _preload_task.add_done_callback(_report_preload)
+    
     # Run the server using stdin/stdout streams
     async with stdio_server() as (read_stream, write_stream):
         await server.run(